@@ -1,58 +1,111 @@
 #!/usr/bin/env python3
 
 from pathlib import Path
+import os
 import re
 import struct
 import csv
-import json
-from datetime import datetime, timedelta, date
-from collections import defaultdict
+from datetime import datetime, timedelta, date, timezone as dt_timezone
+from array import array
+from itertools import repeat
+from operator import itemgetter
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
 from dateutil import tz
 import argparse
 import logging
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 
 _l = logging.getLogger(__name__)
 
+UTC = dt_timezone.utc
+
+# Fitbit exports can be large, read and write them in 64KB blocks
+IO_BUFFER_SIZE = 65536
+
+# Viatom .bin layout: 40 byte header, then one 5 byte record per 4 seconds
+VIATOM_HEADER_SIZE = 40
+# HEADER_LSB, HEADER_MSB and zero padding never change between files
+VIATOM_HEADER_TEMPLATE = bytes([0x5, 0x0]).ljust(VIATOM_HEADER_SIZE, b"\x00")
+# the per-file header fields, packed after HEADER_LSB and HEADER_MSB
+VIATOM_HEADER_FIELDS = struct.Struct("<HBBBBBIH")
+VIATOM_RECORD_SIZE = 5  # SPO2, BPM, INVALID, 2 bytes padding
+VIATOM_MAX_RECORDS = 4095
+# bytes.translate tables mapping a SpO2 value to its SPO2 and INVALID record bytes
+VIATOM_SPO2_VALUE = bytes(0xFF if v <= 61 else min(v, 99) for v in range(256))
+VIATOM_SPO2_INVALID = bytes(0xFF if v <= 61 else 0x00 for v in range(256))
+
 def minutes_to_time(minutes) -> str:
     return f"{int(minutes // 60):02d}:{int(minutes % 60):02d}:{int((minutes % 1) * 60):02d}"
 
-def export_spo2_as_viatom(args):
+def export_spo2_as_viatom(args, executor):
     timezone = read_profile_timezone(args)
     csv_files, json_files = get_spo2_files(args)
     if len(csv_files) == 0 or len(json_files) == 0:
         raise FileNotFoundError("No SpO2 or heart rate data detected!")
 
-    sessions, data = align_spo2_data(csv_files, json_files, timezone)
-    _l.debug("Detected SpO2 sessions:")
-    for s in sessions:
-        _l.debug("".join([
-            s[0].strftime("%Y-%m-%d %H:%M:%S"),
-            "-",
-            s[1].strftime("%Y-%m-%d %H:%M:%S"),])
-        )
-    chunks = divide_data_to_viatom_chunks(sessions, data)
+    tz_local = tz.gettz(timezone)
+    sessions, spo2_samples, bpm_samples = align_spo2_data(csv_files, json_files, executor)
+    if _l.isEnabledFor(logging.DEBUG):
+        _l.debug("Detected SpO2 sessions:")
+        for s in sessions:
+            _l.debug("".join([
+                datetime.fromtimestamp(s[0], tz_local).isoformat(sep=" ", timespec="seconds"),
+                " - ",
+                datetime.fromtimestamp(s[1], tz_local).isoformat(sep=" ", timespec="seconds"),])
+            )
+    chunks = divide_data_to_viatom_chunks(sessions, spo2_samples, bpm_samples)
 
-    for chunk in chunks:
-        write_to_viatom_file(args, chunk)
+    for chunk_ts, chunk_spo2, chunk_bpm in chunks:
+        write_to_viatom_file(args, chunk_ts, chunk_spo2, chunk_bpm, tz_local)
 
-def export_sleep_phases_as_dreem(args):
+def export_sleep_phases_as_dreem(args, executor):
     sleep_path = args.fitbit_path / "Global Export Data"
-    json_files = [file for file in sleep_path.glob("sleep-*.json")]
+    json_files = scan_files(sleep_path, "sleep-", ".json")
     if len(json_files) == 0:
         raise FileNotFoundError("No sleep data detected!")
-    write_to_dreem(args, json_files)
+    write_to_dreem(args, json_files, executor)
 
 def read_profile_timezone(args) -> str:
     timezone = None
-    with open(args.fitbit_path / "Your Profile" / "Profile.csv", "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            timezone = row["timezone"]
+    with open(args.fitbit_path / "Your Profile" / "Profile.csv", "r", buffering=IO_BUFFER_SIZE) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is not None:
+            tz_idx = header.index("timezone")
+            for row in reader:
+                # skip blank lines like csv.DictReader does
+                if row:
+                    timezone = row[tz_idx]
     # replacing if/then RuntimeError
     assert timezone is not None, "Profile not detected!"
     _l.debug("Timezone:", timezone)
     return timezone
 
+def scan_files(path, prefix, suffix) -> list[os.DirEntry]:
+    """Lists the files in path named prefix*suffix, an empty list if path is missing"""
+    try:
+        with os.scandir(path) as entries:
+            return [
+                entry for entry in entries
+                if entry.name.startswith(prefix) and entry.name.endswith(suffix) and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
 def check_file_date(args, file) -> bool:
     """Ensures the file's date is within the threshold requested"""
     _l.debug(file.name)
@@ -62,160 +115,222 @@ def check_file_date(args, file) -> bool:
 
 def get_spo2_files(args) -> tuple[list]:
     spo2_path = args.fitbit_path / "Oxygen Saturation (SpO2)"
-    spo2_files = [file for file in spo2_path.glob("Minute SpO2*.csv") if check_file_date(args, file)]
+    spo2_files = [file for file in scan_files(spo2_path, "Minute SpO2", ".csv") if check_file_date(args, file)]
     bpm_path = args.fitbit_path / "Global Export Data"
-    bpm_files = [file for file in bpm_path.glob("heart_rate-*.json") if check_file_date(args, file)]
+    bpm_files = [file for file in scan_files(bpm_path, "heart_rate-", ".json") if check_file_date(args, file)]
     return spo2_files, bpm_files
 
-def align_spo2_data(csv_files, json_files, timezone) -> tuple[list,dict]:
-    def read_csv(file_name, timezone):
-        with open(file_name, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                utc_timestamp = datetime.strptime(
-                    row["timestamp"], "%Y-%m-%dT%H:%M:%SZ"
-                )
-                utc_datetime = utc_timestamp.replace(tzinfo=tz.gettz('UTC'))
-                timestamp = utc_datetime.astimezone(tz.gettz(timezone))
-                value = round(float(row["value"]))
-                if value < 61:
-                    continue
-                if value == 100:
-                    value = 99
-                yield timestamp, value
-
-    def read_json(file_name, timezone):
-        with open(file_name, "r") as f:
-            data = json.load(f)
-            for entry in data:
-                utc_timestamp = datetime.strptime(
-                    entry["dateTime"], "%m/%d/%y %H:%M:%S"
-                )
-                utc_datetime = utc_timestamp.replace(tzinfo=tz.gettz('UTC'))
-                timestamp = utc_datetime.astimezone(tz.gettz(timezone))
-                value = entry["value"]["bpm"]
-                yield timestamp, value
-
-    data = defaultdict(lambda: [None, None])
-    sessions = []
-    for file_name in csv_files:
-        for timestamp, value in read_csv(file_name, timezone):
-            if len(sessions) == 0:
-                sessions.append([timestamp])
-            else:
-                sessions_start = sessions[-1][0]
-                # start new sleep session if data points are at least 5 minutes apart
-                if timestamp - prev_timestamp > timedelta(minutes=5):
-                    sessions[-1].append(prev_timestamp)
-                    sessions.append([timestamp])
-            data[timestamp][0] = value
-            prev_timestamp = timestamp
+HEART_RATE_DATETIME = re.compile(r"(\d\d)/(\d\d)/(\d\d) (\d\d):(\d\d):(\d\d)")
+
+def parse_spo2_datetime(datestring: str) -> datetime:
+    """Parses the "%Y-%m-%dT%H:%M:%SZ" SpO2 timestamps as aware UTC datetimes"""
+    return datetime.fromisoformat(datestring[:-1] + "+00:00")
+
+if ciso8601 is not None:
+    parse_spo2_datetime = ciso8601.parse_datetime
+
+def parse_heart_rate_datetime(datestring: str) -> datetime:
+    """Parses the "%m/%d/%y %H:%M:%S" heart rate timestamps as aware UTC datetimes"""
+    match = HEART_RATE_DATETIME.fullmatch(datestring)
+    if match is None:
+        return datetime.strptime(datestring, "%m/%d/%y %H:%M:%S").replace(tzinfo=UTC)
+    month, day, year, hour, minute, second = map(int, match.groups())
+    return datetime(year + 2000, month, day, hour, minute, second, tzinfo=UTC)
+
+def sort_samples(timestamps, values) -> tuple[array, array]:
+    """Sorts sample columns by timestamp, samples sharing a timestamp keep the order they were read in"""
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    return (
+        array(timestamps.typecode, map(timestamps.__getitem__, order)),
+        array(values.typecode, map(values.__getitem__, order)),
+    )
+
+def detect_sessions(timestamps) -> list[list[int]]:
+    """Splits SpO2 timestamps into [start, end] sessions wherever they are more than 5 minutes apart"""
+    if len(timestamps) == 0:
+        return []
+    gaps = [
+        i for i, (prev_timestamp, timestamp) in enumerate(zip(timestamps, timestamps[1:]), 1)
+        if timestamp - prev_timestamp > 300
+    ]
+    starts = [0, *gaps]
+    ends = [*gaps, len(timestamps)]
+    return [[timestamps[start], timestamps[end - 1]] for start, end in zip(starts, ends)]
+
+def init_worker_logging(queue, level):
+    """Sends a worker process' log records to the queue of worker_pool"""
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(queue)]
+    root.setLevel(level)
+
+@contextmanager
+def worker_pool():
+    """Process pool whose workers log through this process' logging handlers"""
+    root = logging.getLogger()
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, *root.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(initializer=init_worker_logging, initargs=(queue, root.level)) as executor:
+            yield executor
+    finally:
+        listener.stop()
+
+def map_files(executor, function, files, *args) -> list:
+    """Runs function(file, *args) for every file in the executor, results keep the file order"""
+    paths = [os.fspath(file) for file in files]
+    if len(paths) < 2:
+        return [function(path, *args) for path in paths]
+    return list(executor.map(function, paths, *map(repeat, args)))
+
+def read_spo2_file(file_name) -> tuple[array, array]:
+    """Reads a SpO2 CSV as unix timestamp and value columns, dropping readings below 61"""
+    timestamps, values = array("q"), array("h")
+    with open(file_name, "r", buffering=IO_BUFFER_SIZE) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return timestamps, values
+        columns = itemgetter(header.index("timestamp"), header.index("value"))
+        # skip blank lines like csv.DictReader does
+        rows = [columns(row) for row in reader if row]
+    samples = [(timestamp, round(float(value))) for timestamp, value in rows]
+    samples = [(timestamp, value) for timestamp, value in samples if value >= 61]
+    timestamps.extend(int(parse_spo2_datetime(timestamp).timestamp()) for timestamp, _ in samples)
+    values.extend(min(value, 99) for _, value in samples)
+    return timestamps, values
+
+def read_heart_rate_file(file_name) -> tuple[array, array]:
+    """Reads a heart rate JSON as unix timestamp and bpm columns"""
+    timestamps, values = array("q"), array("h")
+    with open(file_name, "rb", buffering=IO_BUFFER_SIZE) as f:
+        data = _loads(f.read())
+    for entry in data:
+        timestamps.append(int(parse_heart_rate_datetime(entry["dateTime"]).timestamp()))
+        values.append(entry["value"]["bpm"])
+    return timestamps, values
+
+def align_spo2_data(csv_files, json_files, executor) -> tuple[list, tuple[array, array], tuple[array, array]]:
+    """Reads SpO2 and heart rate samples as unix timestamp sorted columns.
+
+    Returns the detected SpO2 sessions as [start, end] unix timestamps along
+    with the (timestamps, values) columns of the SpO2 and heart rate samples.
+    """
+    spo2_timestamps, spo2_values = array("q"), array("h")
+    for timestamps, values in map_files(executor, read_spo2_file, csv_files):
+        spo2_timestamps.extend(timestamps)
+        spo2_values.extend(values)
+    sessions = detect_sessions(spo2_timestamps)
     if len(sessions) == 0:
         raise FileNotFoundError("No SPO2 night sessions detected!")
-    if len(sessions[-1]) == 1:
-        sessions[-1].append(prev_timestamp)
-    last_bpm_timestamp = None
-    for file_name in json_files:
-        for timestamp, value in read_json(file_name, timezone):
-            data[timestamp][1] = value
-            last_bpm_timestamp = timestamp
+    bpm_timestamps, bpm_values = array("q"), array("h")
+    for timestamps, values in map_files(executor, read_heart_rate_file, json_files):
+        bpm_timestamps.extend(timestamps)
+        bpm_values.extend(values)
+    if len(bpm_timestamps) == 0:
+        raise FileNotFoundError("No heart rate data detected!")
+    last_bpm_timestamp = bpm_timestamps[-1]
     filtered_sessions = []
     for s in sessions:
         if s[1] < last_bpm_timestamp:
             filtered_sessions.append(s)
-    return filtered_sessions, data
+    return (
+        filtered_sessions,
+        sort_samples(spo2_timestamps, spo2_values),
+        sort_samples(bpm_timestamps, bpm_values),
+    )
+
+def resample(samples, start, count) -> array:
+    """Values of the last sample at or before each of count 4 second steps from start.
 
-def divide_data_to_viatom_chunks(sessions, data) -> list[list[tuple]]:
-    sorted_data = sorted(data.items())
+    Steps before the first sample take the first sample's value.
+    """
+    timestamps, values = samples
+    column = array("B")
+    i = max(bisect_right(timestamps, start) - 1, 0)
+    while len(column) < count:
+        if i + 1 < len(timestamps):
+            # number of steps before the next sample takes over
+            steps = min(count, max(0, -(-(timestamps[i + 1] - start) // 4)))
+        else:
+            steps = count
+        column.extend(repeat(values[i], steps - len(column)))
+        i += 1
+    return column
+
+def divide_data_to_viatom_chunks(sessions, spo2_samples, bpm_samples) -> list[tuple[array, array, array]]:
     chunks = []
-    chunk = []
     for session in sessions:
-        last_timestamp = None
-        for i in range(len(sorted_data) - 1):
-            if last_timestamp is None:
-                timestamp = sorted_data[i][0]
-            else:
-                timestamp = last_timestamp
-            end_timestamp = sorted_data[i + 1][0]
-            values = sorted_data[i][1]
-            if values[0] is not None:
-                spo2 = values[0]
-            if values[1] is not None:
-                bpm = values[1]
-            if timestamp < session[0] or timestamp > session[1]:
-                continue
-            records = 0
-            while timestamp < end_timestamp:
-                if len(chunk) >= 4095:
-                    chunks.append(chunk)
-                    chunk = []
-                chunk.append((timestamp, spo2, bpm))
-                timestamp += timedelta(seconds=4)
-                records += 1
-            last_timestamp = timestamp
-        if chunk:
-            chunks.append(chunk)
-            chunk = []
-    if chunk:
-        chunks.append(chunk)
+        # records run every 4 seconds from the session start up to the
+        # first SpO2 or heart rate sample after the last step in the session
+        last_step = session[1] - (session[1] - session[0]) % 4
+        end = None
+        for timestamps, _ in (spo2_samples, bpm_samples):
+            index = bisect_right(timestamps, last_step)
+            if index < len(timestamps) and (end is None or timestamps[index] < end):
+                end = timestamps[index]
+        if end is None:
+            end = max(spo2_samples[0][-1], bpm_samples[0][-1])
+        steps = range(session[0], end, 4)
+        spo2_values = resample(spo2_samples, session[0], len(steps))
+        bpm_values = resample(bpm_samples, session[0], len(steps))
+        for offset in range(0, len(steps), VIATOM_MAX_RECORDS):
+            chunk = slice(offset, offset + VIATOM_MAX_RECORDS)
+            chunks.append((array("q", steps[chunk]), spo2_values[chunk], bpm_values[chunk]))
     return chunks
 
-def write_to_viatom_file(args, data):
-    if len(data) > 4095:
+def write_to_viatom_file(args, timestamps, spo2_values, bpm_values, tz_local):
+    start = datetime.fromtimestamp(timestamps[0], tz_local)
+    if len(timestamps) > VIATOM_MAX_RECORDS:
         raise RuntimeError(
-            f"Data chunk ({data[0][0]}, {data[-1][0]}) too long ({len(data)})!"
+            f"Data chunk ({start}, {datetime.fromtimestamp(timestamps[-1], tz_local)}) too long ({len(timestamps)})!"
         )
-    bin_file = "{}.bin".format(data[0][0].strftime("%Y%m%d%H%M%S"))
-    with open(args.export_path / bin_file, "wb") as f:
-        # Write header
-        f.write(struct.pack("<BB", 0x5, 0x0))  # HEADER_LSB, HEADER_MSB
-        f.write(struct.pack("<H", data[0][0].year))  # YEAR_LSB, YEAR_MSB
-        f.write(
-            struct.pack(
-                "<BBBBB",
-                data[0][0].month,
-                data[0][0].day,
-                data[0][0].hour,
-                data[0][0].minute,
-                data[0][0].second,
-            )
-        )  # MONTH, DAY, HOUR, MINUTES, SECONDS
-        f.write(
-            struct.pack("<I", len(data) * 5 + 40)
-        )  # FILESIZE_0, FILESIZE_1, FILESIZE_2, 0x00
-        f.write(struct.pack("<H", len(data) * 4))  # DURATION_LSB, DURATION_MSB
-        f.write(b"\x00" * 25)  # Padding
-
-        # Write records
-        for record in data:
-            if record[1] <= 61:
-                _l.warning("TOOLOW:", record[1])
-                f.write(b"\xFF")
-                f.write(struct.pack("<B", record[2]))
-                f.write(b"\xFF\x00\x00")  # INVALID VALUE
-            else:
-                if record[1] > 99:
-                    _l.warning("TOOHIGH:", record[1])
-                    f.write(struct.pack("<B", 99))  # MAX VALUE
-                else:
-                    f.write(struct.pack("<B", record[1]))  # VALUE
-                f.write(struct.pack("<B", record[2]))
-                f.write(b"\x00\x00\x00")  # Padding
+    bin_file = f"{start.year:04d}{start.month:02d}{start.day:02d}{start.hour:02d}{start.minute:02d}{start.second:02d}.bin"
+    buf = bytearray(VIATOM_HEADER_SIZE + VIATOM_RECORD_SIZE * len(timestamps))
+    buf[:VIATOM_HEADER_SIZE] = VIATOM_HEADER_TEMPLATE
+    VIATOM_HEADER_FIELDS.pack_into(
+        buf,
+        2,
+        start.year,  # YEAR_LSB, YEAR_MSB
+        start.month,
+        start.day,
+        start.hour,
+        start.minute,
+        start.second,
+        len(buf),  # FILESIZE_0, FILESIZE_1, FILESIZE_2, 0x00
+        len(timestamps) * 4,  # DURATION_LSB, DURATION_MSB
+    )
+
+    # Records are filled column by column, every field is a strided slice
+    spo2 = spo2_values.tobytes()
+    buf[VIATOM_HEADER_SIZE::VIATOM_RECORD_SIZE] = spo2.translate(VIATOM_SPO2_VALUE)
+    buf[VIATOM_HEADER_SIZE + 1::VIATOM_RECORD_SIZE] = bpm_values.tobytes()
+    invalid = spo2.translate(VIATOM_SPO2_INVALID)
+    buf[VIATOM_HEADER_SIZE + 2::VIATOM_RECORD_SIZE] = invalid
+    too_low = invalid.count(0xFF)
+    if too_low:
+        _l.warning(f"TOOLOW: {too_low} records in {bin_file}")
+    too_high = len(spo2.translate(None, bytes(range(100))))
+    if too_high:
+        _l.warning(f"TOOHIGH: {too_high} records in {bin_file}")
 
+    with open(args.export_path / bin_file, "wb", buffering=IO_BUFFER_SIZE) as f:
+        f.write(buf)
         _l.info(
-            f"Exported {bin_file} (size: {len(data) * 5 + 40}, duration: {minutes_to_time(len(data)/15)})"
+            f"Exported {bin_file} (size: {len(buf)}, duration: {minutes_to_time(len(timestamps)/15)})"
         )
 
-def generate_dreem_hypnogram(json_data) -> list:
-    levels = {"wake": "WAKE", "rem": "REM", "light": "Light", "deep": "Deep"}
+def generate_dreem_hypnogram(json_data) -> str:
+    """Builds the comma separated hypnogram, one stage per 30 seconds"""
+    levels = {"wake": "WAKE,", "rem": "REM,", "light": "Light,", "deep": "Deep,"}
     sleep_stages = []
     for item in json_data:
         intervals = item["seconds"] // 30
         if item["level"] in levels:
-            sleep_stages.extend([levels[item["level"]]] * intervals)
+            sleep_stages.append(levels[item["level"]] * intervals)
         else:
             _l.warning("Sleep stage '{}' is not recognized".format(item["level"]))
-    return sleep_stages
+    return "".join(sleep_stages)[:-1]
 
 def filter_sleep_data(args, sleep_record: dict[str,any]) -> bool:
     """Replaces the single lambda to match date of sleep information within requested range."""
@@ -226,9 +341,65 @@ def filter_sleep_data(args, sleep_record: dict[str,any]) -> bool:
     sleep_date = date.fromisoformat(sleep_record["dateOfSleep"])
     return args.start_date <= sleep_date <= args.end_date
 
-def write_to_dreem(args, json_files):
-    with open(args.export_path / "sleep.csv", "w", newline="") as csv_file:
+def read_dreem_rows(file_name, args) -> list[list]:
+    """Reads the sleep.csv rows for the requested sleep records of a sleep JSON"""
+    with open(file_name, "rb", buffering=IO_BUFFER_SIZE) as file:
+        json_data = _loads(file.read())
+    rows = []
+    for item in filter(lambda x: filter_sleep_data(args, x), json_data):
+        start_time = item["startTime"]
+        stop_time = item["endTime"]
+        sleep_onset_duration = minutes_to_time(item["duration"] / 60000)
+        light_sleep_duration = minutes_to_time(
+            item["levels"]["summary"]["light"]["minutes"]
+        )
+        deep_sleep_duration = minutes_to_time(
+            item["levels"]["summary"]["deep"]["minutes"]
+        )
+        rem_duration = minutes_to_time(
+            item["levels"]["summary"]["rem"]["minutes"]
+        )
+        wake_after_sleep_onset_duration = minutes_to_time(
+            item["minutesAwake"]
+        )
+        number_of_awakenings = item["levels"]["summary"]["wake"][
+            "count"
+        ]
+        sleep_efficiency = item["efficiency"]
+        hypnogram = generate_dreem_hypnogram(
+            item["levels"]["data"]
+        )
+
+        rows.append(
+            [
+                start_time,
+                stop_time,
+                sleep_onset_duration,
+                light_sleep_duration,
+                deep_sleep_duration,
+                rem_duration,
+                wake_after_sleep_onset_duration,
+                number_of_awakenings,
+                sleep_efficiency,
+                f"[{hypnogram}]",
+            ]
+        )
+    return rows
+
+DREEM_QUOTED_CHARS = re.compile(r'["\r\n]')
+
+def write_to_dreem(args, json_files, executor):
+    with open(args.export_path / "sleep.csv", "w", newline="", buffering=IO_BUFFER_SIZE) as csv_file:
         writer = csv.writer(csv_file, delimiter=";")
+
+        def writerow(row):
+            # fields without delimiters or quotes can be joined as is
+            line = ";".join(["" if field is None else str(field) for field in row])
+            if line.count(";") == len(row) - 1 and DREEM_QUOTED_CHARS.search(line) is None:
+                csv_file.write(line + writer.dialect.lineterminator)
+            else:
+                writer.writerow(row)
+
         writer.writerow(
             [
                 "Start Time",
@@ -244,50 +415,10 @@ def write_to_dreem(args, json_files):
             ]
         )
 
-        for file in json_files:
-            with open(file, "r") as file:
-                json_data = json.load(file)
-                filtered_data = filter(lambda x: filter_sleep_data(args,x),
-                    json_data)
-                for item in filtered_data:
-                    start_time = item["startTime"]
-                    stop_time = item["endTime"]
-                    _l.info(f"Export to dreem sleep: {start_time} - {stop_time}")
-                    sleep_onset_duration = minutes_to_time(item["duration"] / 60000)
-                    light_sleep_duration = minutes_to_time(
-                        item["levels"]["summary"]["light"]["minutes"]
-                    )
-                    deep_sleep_duration = minutes_to_time(
-                        item["levels"]["summary"]["deep"]["minutes"]
-                    )
-                    rem_duration = minutes_to_time(
-                        item["levels"]["summary"]["rem"]["minutes"]
-                    )
-                    wake_after_sleep_onset_duration = minutes_to_time(
-                        item["minutesAwake"]
-                    )
-                    number_of_awakenings = item["levels"]["summary"]["wake"][
-                        "count"
-                    ]
-                    sleep_efficiency = item["efficiency"]
-                    hypnogram = generate_dreem_hypnogram(
-                        item["levels"]["data"]
-                    )
-
-                    writer.writerow(
-                        [
-                            start_time,
-                            stop_time,
-                            sleep_onset_duration,
-                            light_sleep_duration,
-                            deep_sleep_duration,
-                            rem_duration,
-                            wake_after_sleep_onset_duration,
-                            number_of_awakenings,
-                            sleep_efficiency,
-                            f"[{','.join(hypnogram)}]",
-                        ]
-                    )
+        for rows in map_files(executor, read_dreem_rows, json_files, args):
+            for row in rows:
+                _l.info(f"Export to dreem sleep: {row[0]} - {row[1]}")
+                writerow(row)
 
 
 def get_fitbit_path(s) -> Path:
@@ -374,8 +505,9 @@ if __name__ == "__main__":
         export_path: Path = args.export_path
         if not export_path.exists():
             export_path.mkdir()
-        export_spo2_as_viatom(args)
-        export_sleep_phases_as_dreem(args)
+        with worker_pool() as executor:
+            export_spo2_as_viatom(args, executor)
+            export_sleep_phases_as_dreem(args, executor)
         finish_message = f"Finished processing in {datetime.now() - script_start}"
         print(finish_message)
         if args.logfile is not None: